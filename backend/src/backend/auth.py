@@ -9,6 +9,7 @@ from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 
 from . import models, schemas, database
+from .cache import TTLCache
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
@@ -38,6 +39,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Resolved users keyed by email, so authenticated requests skip the users lookup.
+user_cache = TTLCache(maxsize=10_000, ttl=60)
+
 
 def get_user(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
@@ -58,7 +62,13 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
 
-    user = get_user(db, email=token_data.email)
+    user = user_cache.get(token_data.email)
     if user is None:
-        raise credentials_exception
-    return user
\ No newline at end of file
+        user = get_user(db, email=token_data.email)
+        if user is None:
+            raise credentials_exception
+
+        # Detach the user so commits in this request's session don't expire the cached copy.
+        db.expunge(user)
+        user_cache.set(token_data.email, user)
+    return user
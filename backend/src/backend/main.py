@@ -1,24 +1,113 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import List, Optional
 from datetime import timedelta
+from functools import lru_cache
 
 from fastapi import Depends, FastAPI, HTTPException, status, BackgroundTasks
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import case
+from sqlalchemy import case, insert, text
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 from . import auth, models, schemas, database, tasks
+from .cache import TTLCache
 
-import chromadb
+import torch
 from sentence_transformers import SentenceTransformer
 
-models.Base.metadata.create_all(bind=database.engine)
+models.init_db(database.engine)
+# Don't carry pooled SQLite connections across the fork into gunicorn workers.
+database.engine.dispose()
 
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-chroma_client = chromadb.PersistentClient(path="chroma_db")
-paper_collection = chroma_client.get_collection(name="papers")
+# PyTorch often defaults to a single thread in containers; 4-8 threads is the sweet spot for MiniLM.
+torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", min(4, os.cpu_count() or 1))))
+torch.set_num_interop_threads(1)
 
-app = FastAPI()
+
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    # Loaded lazily, once per process, so that with `gunicorn --preload` the model is built in
+    # each worker after the fork rather than in the master.
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+    if os.getenv("QUANTIZE_EMBEDDING_MODEL", "true").lower() == "true":
+        # Dynamic int8 quantization of the Linear layers makes CPU query encoding 2-4x faster.
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+SEARCH_CANDIDATES = 200
+# Fully ranked hybrid-search ids keyed on (normalized search, has_code).
+search_rankings_cache = TTLCache(maxsize=1024, ttl=300)
+paper_count_cache = TTLCache(maxsize=4, ttl=30)
+recommendations_cache = TTLCache(maxsize=4096, ttl=600)
+
+# Query encoding gets its own small pool so concurrent searches neither oversubscribe
+# the PyTorch threads nor starve the default threadpool used by the other endpoints.
+encode_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ENCODE_WORKERS", 2)), thread_name_prefix="encode"
+)
+
+
+@lru_cache(maxsize=4096)
+def _encode_query(query: str):
+    embedding = get_embedding_model().encode(query, normalize_embeddings=True, convert_to_numpy=True)
+    # The array is shared by every caller of the cache, so make sure nobody mutates it.
+    embedding.setflags(write=False)
+    return embedding
+
+
+def _semantic_search(query: str, n_results: int, has_code: Optional[bool] = None) -> List[str]:
+    """
+    Returns the ids of the papers closest to the query. Only called on a
+    search_rankings_cache miss, so later pages of a search never reach ChromaDB.
+    """
+    results = tasks.get_paper_collection().query(
+        query_embeddings=_encode_query(query)[None, :],
+        n_results=n_results,
+        # Let ChromaDB filter on the `has_code` metadata so every candidate can survive the SQL filter.
+        where={"has_code": has_code} if has_code is not None else None,
+    )
+    return results["ids"][0]
+
+
+def _keyword_search(db: Session, query: str, limit: int) -> List[str]:
+    """
+    Returns the ids of papers whose title or abstract contains the query, using the
+    trigram full-text index instead of scanning the table with ILIKE.
+    """
+    # Trigrams cannot match anything shorter than three characters.
+    if len(query) < 3:
+        return []
+
+    try:
+        rows = db.execute(
+            text(
+                "SELECT papers.id FROM papers_fts JOIN papers ON papers.rowid = papers_fts.rowid "
+                "WHERE papers_fts MATCH :query ORDER BY rank LIMIT :limit"
+            ),
+            {"query": '"' + query.replace('"', '""') + '"', "limit": limit},
+        ).all()
+    except OperationalError as e:
+        print(f"Keyword search failed for '{query}': {e}")
+        return []
+
+    return [row.id for row in rows]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in each worker after the gunicorn fork; both embedding models are loaded here, not at import.
+    get_embedding_model().encode("warmup", show_progress_bar=False)
+    tasks.warm_up_embedding_model()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -102,25 +191,104 @@ def submit_paper_for_processing(
 
     return {"message": "Paper submission accepted for processing."}
 
+@app.post("/papers/submit_batch", status_code=status.HTTP_202_ACCEPTED)
+def submit_papers_for_processing(
+        submission: schemas.ArxivBatchSubmission,
+        background_tasks: BackgroundTasks,
+        db: Session = Depends(database.get_db),
+        current_user: models.User = Depends(auth.get_current_user),
+):
+    arxiv_ids = list(dict.fromkeys(submission.arxiv_ids))
+    processed_ids = {
+        row.id for row in
+        db.query(models.Paper.id).filter(models.Paper.id.in_(arxiv_ids), models.Paper.processed == 2)
+    }
+    pending_ids = [arxiv_id for arxiv_id in arxiv_ids if arxiv_id not in processed_ids]
+
+    if pending_ids:
+        # One task for the whole batch so arXiv metadata is fetched in a single request.
+        background_tasks.add_task(tasks.process_new_papers, pending_ids)
+
+    return {
+        "message": f"{len(pending_ids)} paper(s) accepted for processing.",
+        "accepted": pending_ids,
+        "already_processed": [arxiv_id for arxiv_id in arxiv_ids if arxiv_id in processed_ids],
+    }
+
+def _paper_item(row) -> dict:
+    # A plain dict: every route using this declares a response_model, which validates the
+    # item (authors validator included) once on the way out, so building a model here
+    # would only validate it twice.
+    return {"id": row.id, "title": row.title, "authors": row.authors}
+
+
 @app.get("/papers", response_model=schemas.PaginatedPaperResponse)
-def read_papers(
+async def read_papers(
     db: Session = Depends(database.get_db),
     page: int = 1,
     per_page: int = 12,
     search: Optional[str] = None,
     has_code: Optional[bool] = None,
 ):
+    search = search.strip() if search else None
+    semantic_ids = []
+    ranked_ids = None
     if search:
+        # Later pages of the same search reuse the ranking computed for the first one.
+        ranked_ids = search_rankings_cache.get((search.lower(), has_code))
+
+    if search and ranked_ids is None:
         print(f"Performing hybrid search for: '{search}'")
 
-        query_embedding = embedding_model.encode(search).tolist()
-        results = paper_collection.query(
-            query_embeddings=[query_embedding],
-            n_results=200,  # Get a decent number of candidates
+        # Get a decent number of candidates
+        semantic_ids = await asyncio.get_running_loop().run_in_executor(
+            encode_pool, _semantic_search, search.lower(), SEARCH_CANDIDATES, has_code
         )
-        semantic_ids = results["ids"][0]
 
-        if not semantic_ids:
+    return await run_in_threadpool(
+        _list_papers, db, page, per_page, search, has_code, semantic_ids, ranked_ids
+    )
+
+
+def _list_papers(
+    db: Session,
+    page: int,
+    per_page: int,
+    search: Optional[str],
+    has_code: Optional[bool],
+    semantic_ids: List[str],
+    ranked_ids: Optional[List[str]] = None,
+):
+    offset = (page - 1) * per_page
+
+    if search and ranked_ids is not None:
+        if not ranked_ids:
+            return {"total_items": 0, "total_pages": 0, "page": 1, "per_page": per_page, "items": []}
+
+        page_ids = ranked_ids[offset:offset + per_page]
+        rows = (
+            db.query(models.Paper.id, models.Paper.title, models.Paper.authors)
+            .filter(models.Paper.id.in_(page_ids))
+            .all()
+        )
+        page_order = {id: i for i, id in enumerate(page_ids)}
+        rows.sort(key=lambda row: page_order[row.id])
+
+        return {
+            "total_items": len(ranked_ids),
+            "total_pages": (len(ranked_ids) + per_page - 1) // per_page,
+            "page": page,
+            "per_page": per_page,
+            "items": [_paper_item(p) for p in rows],
+        }
+
+    if search:
+        # Top up the semantic candidates with keyword matches the embedding missed.
+        keyword_ids = _keyword_search(db, search, SEARCH_CANDIDATES)
+        candidate_ids = list(dict.fromkeys(semantic_ids + keyword_ids))
+
+        if not candidate_ids:
+            search_rankings_cache.set((search.lower(), has_code), [])
             return {"total_items": 0, "total_pages": 0, "page": 1, "per_page": per_page, "items": []}
 
         # This gives a huge boost to title matches.
@@ -137,43 +305,42 @@ def read_papers(
             else_=1
         ).label("ranking_score")
 
-        # We also need to preserve the original semantic order for items with the same score.
-        semantic_order = case(
-            {id: i for i, id in enumerate(semantic_ids)},
-            value=models.Paper.id
-        ).label("semantic_order")
-
         query = (
-            db.query(models.Paper)
-            .filter(models.Paper.id.in_(semantic_ids))
-            .order_by(ranking_score.desc(), semantic_order.asc())  # Order by our new score first!
+            db.query(models.Paper.id, models.Paper.title, models.Paper.authors, ranking_score)
+            .filter(models.Paper.id.in_(candidate_ids))
         )
 
     else:
-        query = db.query(models.Paper).order_by(models.Paper.title.desc())
+        # Only the columns needed for the listing, so the large TEXT columns are never read.
+        query = (
+            db.query(models.Paper.id, models.Paper.title, models.Paper.authors)
+            .order_by(models.Paper.title.desc())
+        )
 
+    # Semantic candidates are already filtered in ChromaDB; this also covers the keyword matches.
     if has_code is not None:
-        if has_code:
-            query = query.filter(models.Paper.code_links.isnot(None)).filter(
-                models.Paper.code_links != "[]"
-            )
-        else:
-            query = query.filter(
-                (models.Paper.code_links.is_(None)) | (models.Paper.code_links == "[]")
-            )
+        query = query.filter(models.Paper.has_code == has_code)
 
-    total_items = query.count()
-    offset = (page - 1) * per_page
-    papers = query.offset(offset).limit(per_page).all()
+    if search:
+        rows = query.all()
 
-    parsed_papers = [
-        schemas.PaperBase(
-            id=p.id,
-            title=p.title,
-            authors=p.get_authors_list(),
-        )
-        for p in papers
-    ]
+        # Order by our score first, then preserve the original semantic order for items with the same score.
+        semantic_order = {id: i for i, id in enumerate(candidate_ids)}
+        rows.sort(key=lambda row: (-row.ranking_score, semantic_order[row.id]))
+        search_rankings_cache.set((search.lower(), has_code), [row.id for row in rows])
+
+        # The candidates are bounded by SEARCH_CANDIDATES, so we paginate in Python instead of COUNT + OFFSET.
+        total_items = len(rows)
+        papers = rows[offset:offset + per_page]
+    else:
+        # The unfiltered listing only varies by `has_code`, so its total barely changes between requests.
+        total_items = paper_count_cache.get(has_code)
+        if total_items is None:
+            total_items = query.order_by(None).count()
+            paper_count_cache.set(has_code, total_items)
+        papers = query.offset(offset).limit(per_page).all()
+
+    parsed_papers = [_paper_item(p) for p in papers]
 
     return {
         "total_items": total_items,
@@ -189,46 +356,41 @@ def get_recommendations(paper_id: str, db: Session = Depends(database.get_db)):
     print(f"\n--- Getting recommendations for paper_id: '{paper_id}' ---")
 
     try:
-        retrieved_item = paper_collection.get(ids=[paper_id], include=["embeddings"])
+        # Neighbours only change when papers are added, so the two ChromaDB round trips
+        # (fetch the embedding, then query with it) are skipped for recently seen papers.
+        recommended_ids = recommendations_cache.get(paper_id)
+        if recommended_ids is None:
+            paper_collection = tasks.get_paper_collection()
+            retrieved_item = paper_collection.get(ids=[paper_id], include=["embeddings"])
 
-        if not retrieved_item or not retrieved_item["ids"]:
-            print(f"Error: Paper ID '{paper_id}' NOT FOUND in ChromaDB collection.")
-            return []
+            if not retrieved_item or not retrieved_item["ids"]:
+                print(f"Error: Paper ID '{paper_id}' NOT FOUND in ChromaDB collection.")
+                return []
 
-        query_embedding = retrieved_item["embeddings"]
+            query_embedding = retrieved_item["embeddings"]
 
-        results = paper_collection.query(
-            query_embeddings=query_embedding, n_results=6  # Get top 5 + the item itself
-        )
+            results = paper_collection.query(
+                query_embeddings=query_embedding, n_results=6  # Get top 5 + the item itself
+            )
 
-        recommended_ids = [pid for pid in results["ids"][0] if pid != paper_id]
+            recommended_ids = [pid for pid in results["ids"][0] if pid != paper_id]
+            recommendations_cache.set(paper_id, recommended_ids)
 
         if not recommended_ids:
             print("No other similar papers found after excluding the source paper.")
             return []
 
-        from sqlalchemy import case
-
-        ordering = case(
-            {id: i for i, id in enumerate(recommended_ids)}, value=models.Paper.id
-        )
         papers = (
-            db.query(models.Paper)
+            db.query(models.Paper.id, models.Paper.title, models.Paper.authors)
             .filter(models.Paper.id.in_(recommended_ids))
-            .order_by(ordering)
             .all()
         )
+        ordering = {id: i for i, id in enumerate(recommended_ids)}
+        papers.sort(key=lambda p: ordering[p.id])
 
         print(f"Successfully fetched {len(papers)} papers from SQLite.")
 
-        return [
-            schemas.PaperBase(
-                id=p.id,
-                title=p.title,
-                authors=p.get_authors_list(),
-            )
-            for p in papers
-        ]
+        return [_paper_item(p) for p in papers]
     except Exception as e:
         # This can happen if the paper_id is not in ChromaDB
         print(f"Could not get recommendations for {paper_id}: {e}")
@@ -245,12 +407,12 @@ def read_paper(paper_id: str, db: Session = Depends(database.get_db)):
         id=db_paper.id,
         title=db_paper.title,
         abstract=db_paper.abstract,
-        authors=db_paper.get_authors_list(),
+        authors=db_paper.authors,
         contribution=db_paper.contribution,
-        tasks=db_paper.get_tasks_list(),
-        methods=db_paper.get_methods_list(),
-        datasets=db_paper.get_datasets_list(),
-        code_links=db_paper.get_code_links_list(),
+        tasks=db_paper.tasks,
+        methods=db_paper.methods,
+        datasets=db_paper.datasets,
+        code_links=db_paper.code_links,
     )
 
 @app.get("/papers/status/{arxiv_id}", status_code=status.HTTP_200_OK)
@@ -279,25 +441,24 @@ def create_bookmark(
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user),
 ):
-    db_paper = db.query(models.Paper).filter(models.Paper.id == paper_id).first()
-    if not db_paper:
-        raise HTTPException(status_code=404, detail="Paper not found")
-
-    existing_bookmark = (
-        db.query(models.Bookmark)
-        .filter(
-            models.Bookmark.user_id == current_user.id,
-            models.Bookmark.paper_id == paper_id,
+    try:
+        result = db.execute(
+            insert(models.Bookmark)
+            .prefix_with("OR IGNORE")
+            .values(user_id=current_user.id, paper_id=paper_id)
         )
-        .first()
-    )
-    if existing_bookmark:
+        db.commit()
+    except IntegrityError:
+        # OR IGNORE only covers the unique index; the foreign key still rejects unknown papers.
+        # Only that case is a 404, so check the paper before blaming it.
+        db.rollback()
+        if db.query(models.Paper.id).filter(models.Paper.id == paper_id).first() is None:
+            raise HTTPException(status_code=404, detail="Paper not found")
+        raise
+
+    if result.rowcount == 0:
         raise HTTPException(status_code=400, detail="Paper already bookmarked")
 
-    new_bookmark = models.Bookmark(user_id=current_user.id, paper_id=paper_id)
-    db.add(new_bookmark)
-    db.commit()
-
     return {"detail": "Bookmark added successfully"}
 
 
@@ -329,13 +490,11 @@ def get_my_bookmarks(
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user),
 ):
+    # Served by the (user_id, paper_id) unique index; only the listing columns are read from papers.
     bookmarked_papers = (
-        db.query(models.Paper)
-        .join(models.Bookmark)
+        db.query(models.Paper.id, models.Paper.title, models.Paper.authors)
+        .join(models.Bookmark, models.Bookmark.paper_id == models.Paper.id)
         .filter(models.Bookmark.user_id == current_user.id)
         .all()
     )
-    return [
-        schemas.PaperBase(id=p.id, title=p.title, authors=p.get_authors_list())
-        for p in bookmarked_papers
-    ]
+    return [_paper_item(p) for p in bookmarked_papers]
@@ -1,8 +1,10 @@
-import json
-from sqlalchemy import Boolean, Column, Integer, String, Text, ForeignKey
+import orjson
+from sqlalchemy import JSON, Boolean, Column, Integer, String, Text, ForeignKey, Index, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship
 from .database import Base
 
+
 class User(Base):
     __tablename__ = "users"
 
@@ -19,35 +21,20 @@ class Paper(Base):
     id = Column(String, primary_key=True, index=True)
     title = Column(String, index=True)
     abstract = Column(Text)
-    authors = Column(Text)  # JSON string
+    authors = Column(JSON, default=list)
     contribution = Column(Text)
-    tasks = Column(Text) # JSON string
-    methods = Column(Text) # JSON string
-    datasets = Column(Text) # JSON string
-    code_links = Column(Text) # JSON string
+    tasks = Column(JSON, default=list)
+    methods = Column(JSON, default=list)
+    datasets = Column(JSON, default=list)
+    code_links = Column(JSON, default=list)
+    has_code = Column(Boolean, index=True, default=False, server_default=text("0"))
     processed = Column(Integer, default=0)
 
-    def get_authors_list(self):
-        if self.authors is None:
-            return []
-
-        authors = self.authors if self.authors.startswith('"') else f'"{self.authors}"'
-        return json.loads(authors).split(",")
-
-    def get_tasks_list(self):
-        return json.loads(self.tasks if len(self.tasks.strip("'").strip('"')) > 0 else '[]')
-
-    def get_methods_list(self):
-        return json.loads(self.methods if len(self.methods.strip("'").strip('"')) > 0 else '[]')
-
-    def get_datasets_list(self):
-        return json.loads(self.datasets if len(self.datasets.strip("'").strip('"')) > 0 else '[]')
-
-    def get_code_links_list(self):
-        return json.loads(self.code_links if len(self.code_links.strip("'").strip('"')) > 0 else '[]')
-
 class Bookmark(Base):
     __tablename__ = "bookmarks"
+    __table_args__ = (
+        Index("uq_bookmarks_user_paper", "user_id", "paper_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -55,3 +42,132 @@ class Bookmark(Base):
 
     owner = relationship("User", back_populates="bookmarks")
     paper = relationship("Paper")
+
+# Trigram FTS5 index over papers, kept in sync by triggers so that substring
+# (ILIKE '%term%') searches do not need a full table scan.
+PAPER_SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE papers_fts USING fts5(
+        title, abstract, content='papers', content_rowid='rowid', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER papers_fts_ai AFTER INSERT ON papers BEGIN
+        INSERT INTO papers_fts(rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract);
+    END
+    """,
+    """
+    CREATE TRIGGER papers_fts_ad AFTER DELETE ON papers BEGIN
+        INSERT INTO papers_fts(papers_fts, rowid, title, abstract) VALUES ('delete', old.rowid, old.title, old.abstract);
+    END
+    """,
+    """
+    CREATE TRIGGER papers_fts_au AFTER UPDATE OF title, abstract ON papers BEGIN
+        INSERT INTO papers_fts(papers_fts, rowid, title, abstract) VALUES ('delete', old.rowid, old.title, old.abstract);
+        INSERT INTO papers_fts(rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract);
+    END
+    """,
+    "INSERT INTO papers_fts(papers_fts) VALUES ('rebuild')",
+]
+
+
+def create_search_index(conn):
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'papers_fts'")
+    ).first()
+    if exists:
+        return
+
+    try:
+        for statement in PAPER_SEARCH_INDEX_DDL:
+            conn.execute(text(statement))
+    except OperationalError as e:
+        # The trigram tokenizer needs SQLite 3.34+; search falls back to semantic matches only.
+        print(f"Could not create the full-text search index: {e}")
+
+
+def _parse_legacy_authors(authors):
+    try:
+        authors = orjson.loads(authors)
+    except orjson.JSONDecodeError:
+        pass
+
+    if isinstance(authors, list):
+        return [str(a) for a in authors]
+    if authors is None:
+        return []
+    return [a.strip() for a in str(authors).split(",") if a.strip()]
+
+
+def migrate_authors_to_json_arrays(conn):
+    """
+    Older rows store authors as a comma-separated string (sometimes JSON-quoted).
+    Rewrites them as JSON arrays so they can be decoded without re-splitting.
+    """
+    rows = conn.execute(
+        text(
+            "SELECT id, authors FROM papers WHERE authors IS NOT NULL "
+            "AND (CASE WHEN json_valid(authors) THEN json_type(authors) END) IS NOT 'array'"
+        )
+    ).all()
+    if not rows:
+        return
+
+    print(f"Migrating authors of {len(rows)} papers to JSON arrays...")
+    conn.execute(
+        text("UPDATE papers SET authors = :authors WHERE id = :id"),
+        [{"id": row.id, "authors": orjson.dumps(_parse_legacy_authors(row.authors)).decode()} for row in rows],
+    )
+
+
+def migrate_list_columns_to_json_arrays(conn):
+    """
+    Older rows may hold '', "''" or other non-array values in the JSON list
+    columns. Normalizes them to '[]' so the JSON column type can decode them.
+    """
+    for column in ("tasks", "methods", "datasets", "code_links"):
+        result = conn.execute(
+            text(
+                f"UPDATE papers SET {column} = '[]' WHERE {column} IS NOT NULL "
+                f"AND (CASE WHEN json_valid({column}) THEN json_type({column}) END) IS NOT 'array'"
+            )
+        )
+        if result.rowcount:
+            print(f"Normalized {column} of {result.rowcount} papers to JSON arrays.")
+
+
+def migrate_has_code(conn):
+    columns = [row.name for row in conn.execute(text("PRAGMA table_info(papers)"))]
+    if "has_code" in columns:
+        return
+
+    print("Adding the has_code column to papers...")
+    conn.execute(text("ALTER TABLE papers ADD COLUMN has_code BOOLEAN DEFAULT 0"))
+    conn.execute(text("UPDATE papers SET has_code = (code_links IS NOT NULL AND code_links != '[]')"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_papers_has_code ON papers (has_code)"))
+
+
+def migrate_bookmarks_unique(conn):
+    """
+    Bookmarks created before the unique index existed may contain duplicates,
+    which have to go before the index can be built.
+    """
+    conn.execute(
+        text(
+            "DELETE FROM bookmarks WHERE id NOT IN "
+            "(SELECT MIN(id) FROM bookmarks GROUP BY user_id, paper_id)"
+        )
+    )
+    conn.execute(
+        text("CREATE UNIQUE INDEX IF NOT EXISTS uq_bookmarks_user_paper ON bookmarks (user_id, paper_id)")
+    )
+
+
+def init_db(engine):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        create_search_index(conn)
+        migrate_authors_to_json_arrays(conn)
+        migrate_list_columns_to_json_arrays(conn)
+        migrate_has_code(conn)
+        migrate_bookmarks_unique(conn)
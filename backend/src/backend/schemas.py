@@ -1,12 +1,23 @@
-from pydantic import BaseModel, EmailStr
+import orjson
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
 from typing import List, Optional
 
 # --- Paper Schemas ---
 class PaperBase(BaseModel):
+    model_config = ConfigDict(from_attributes=True, extra="forbid")
+
     id: str
     title: str
     authors: List[str] = ()
 
+    @field_validator("authors", mode="before")
+    @classmethod
+    def parse_authors(cls, value):
+        # The JSON column already decodes rows; raw JSON array text is still accepted.
+        if isinstance(value, (str, bytes)):
+            return orjson.loads(value) if value else []
+        return value or []
+
 class Paper(PaperBase):
     abstract: Optional[str] = None
     contribution: Optional[str] = None
@@ -15,8 +26,11 @@ class Paper(PaperBase):
     datasets: List[str] = ()
     code_links: List[str] = ()
 
-    class Config:
-        from_attributes = True
+    @field_validator("tasks", "methods", "datasets", "code_links", mode="before")
+    @classmethod
+    def default_empty_list(cls, value):
+        # Papers that have not been processed yet have NULL here.
+        return value or []
 
 class PaginatedPaperResponse(BaseModel):
     total_items: int
@@ -34,10 +48,9 @@ class UserCreate(UserBase):
     password: str
 
 class User(UserBase):
-    id: int
+    model_config = ConfigDict(from_attributes=True)
 
-    class Config:
-        from_attributes = True
+    id: int
 
 # --- Token Schemas (for Authentication) ---
 class Token(BaseModel):
@@ -50,3 +63,6 @@ class TokenData(BaseModel):
 # --- Submission Schema ---
 class ArxivSubmission(BaseModel):
     arxiv_id: str
+
+class ArxivBatchSubmission(BaseModel):
+    arxiv_ids: List[str] = Field(..., min_length=1, max_length=100)
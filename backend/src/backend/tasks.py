@@ -1,30 +1,108 @@
 import os
+import re
 import arxiv
 import sqlite3
-import json
+import threading
+import orjson
 import chromadb
+import numpy as np
+import torch
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 from zhipuai import ZhipuAI
 
 DB_FILE = "papers.db"
 CHROMA_DB_PATH = "chroma_db"
+# Every client on CHROMA_DB_PATH in this process must use the same settings.
+CHROMA_SETTINGS = Settings(anonymized_telemetry=False, allow_reset=False)
 COLLECTION_NAME = "papers"
+# Keep in sync with processing/generate_embeddings.py, which normally creates the collection.
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
 MODEL_NAME = "all-MiniLM-L6-v2"
+MAX_SEQ_LENGTH = 256
+# Comfortably above MAX_SEQ_LENGTH tokens of English, so the tokenizer never sees text it would drop anyway.
+MAX_EMBED_CHARS = 1500
 ZHIPU_API_KEY = os.getenv("ZHIPU_API_KEY")
 
 PAGES_FROM_START = 15
 PAGES_FROM_END = 10
+# Papers of one batch that are downloaded and sent to the LLM at the same time.
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", 8))
+# arXiv asks clients to stay polite, so fewer PDF downloads than extractions run at once.
+ARXIV_DOWNLOAD_SLOTS = 4
+# On CPU, "onnx" runs one of the pre-exported ONNX graphs published with the model
+# through ONNX Runtime; "torch" keeps the eager PyTorch model.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "onnx/model_quint8_avx2.onnx")
+
+EMBEDDING_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    # Loaded lazily, once per process: with `gunicorn --preload` an ONNX Runtime session built
+    # in the master would reach the forked workers without its thread pool and hang on first use.
+    print("[WORKER_INIT] Loading SentenceTransformer model...")
+    if EMBEDDING_DEVICE == "cuda":
+        # Keep the kernels cuDNN autotunes for each batch shape instead of re-selecting them.
+        torch.backends.cudnn.benchmark = True
+        model = SentenceTransformer(MODEL_NAME, device=EMBEDDING_DEVICE)
+        model.half()
+    elif EMBEDDING_BACKEND == "onnx":
+        model = SentenceTransformer(
+            MODEL_NAME, device=EMBEDDING_DEVICE, backend="onnx", model_kwargs={"file_name": ONNX_MODEL_FILE}
+        )
+    else:
+        # The PyTorch thread count is process-wide and set once in main.py (TORCH_NUM_THREADS).
+        model = SentenceTransformer(MODEL_NAME, device=EMBEDDING_DEVICE)
+    model.max_seq_length = MAX_SEQ_LENGTH
+    print(f"[WORKER_INIT] Model loaded on {EMBEDDING_DEVICE} ({EMBEDDING_BACKEND if EMBEDDING_DEVICE == 'cpu' else 'torch'}).")
+    return model
+
+
+def warm_up_embedding_model():
+    """
+    Loads the model and runs one throwaway batch so the first real paper does not
+    pay for lazy initialization (CUDA context and kernel selection, ONNX session setup).
+    Call it in the process that serves jobs, i.e. after any fork.
+    """
+    get_embedding_model().encode(["warmup"] * 8, batch_size=8, show_progress_bar=False)
+
+
+# Background tasks run on a thread pool, so access to the shared connection is serialized.
+_sqlite_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _get_sqlite_connection():
+    conn = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@lru_cache(maxsize=None)
+def get_paper_collection():
+    # Opened lazily, once per process, so that with `gunicorn --preload` each forked worker gets
+    # its own handle on the persistent store.
+    chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH, settings=CHROMA_SETTINGS)
+    return chroma_client.get_or_create_collection(name=COLLECTION_NAME, metadata=COLLECTION_METADATA)
 
-print("[WORKER_INIT] Loading SentenceTransformer model...")
-embedding_model = SentenceTransformer(MODEL_NAME)
-print("[WORKER_INIT] Model loaded.")
 
 print("[WORKER_INIT] Initializing ZhipuAI client...")
 zhipu_client = ZhipuAI(api_key=ZHIPU_API_KEY)
 print("[WORKER_INIT] ZhipuAI client initialized.")
 
-arxiv_client = arxiv.Client()
+arxiv_client = arxiv.Client(page_size=50, delay_seconds=3, num_retries=3)
+_download_slots = threading.Semaphore(ARXIV_DOWNLOAD_SLOTS)
 print("[WORKER_INIT] Arxiv client initialized.")
 
 
@@ -65,6 +143,42 @@ Example output format:
 """
 
 
+_WHITESPACE_RE = re.compile(r"\s+")
+_REFERENCE_ENTRY_RE = re.compile(r"^\[\d+\]\s")
+_REFERENCES_HEADING_RE = re.compile(r"^(\d+\.?\s*)?(references|bibliography)$", re.IGNORECASE)
+_APPENDIX_HEADING_RE = re.compile(r"^([a-z]\.?\s+)?(appendix|appendices|supplementary)", re.IGNORECASE)
+# Blocks starting in the bottom band of a page are page numbers, running footers and the like.
+FOOTER_BAND = 0.93
+
+
+def _pages_text(pages, flags):
+    """
+    Joins the text blocks of `pages`, leaving out what only costs LLM tokens:
+    page footers and the reference list (up to a following appendix).
+    """
+    parts = []
+    in_references = False
+    for page in pages:
+        footer_top = page.rect.y1 * FOOTER_BAND
+        for x0, y0, x1, y1, block_text, block_no, block_type in page.get_text("blocks", flags=flags):
+            if block_type != 0 or y0 >= footer_top:
+                continue
+
+            block_text = _WHITESPACE_RE.sub(" ", block_text).strip()
+            if not block_text:
+                continue
+            if _REFERENCES_HEADING_RE.match(block_text):
+                in_references = True
+                continue
+            if in_references and _APPENDIX_HEADING_RE.match(block_text):
+                in_references = False
+            if in_references or _REFERENCE_ENTRY_RE.match(block_text):
+                continue
+
+            parts.append(block_text)
+    return "\n".join(parts)
+
+
 def extract_text_from_pdf(pdf_path):
     """
     Worker function that opens a PDF, extracts key text, and returns it.
@@ -73,23 +187,18 @@ def extract_text_from_pdf(pdf_path):
         import pymupdf
 
         filename = os.path.splitext(os.path.basename(pdf_path))[0]
-        doc = pymupdf.open(pdf_path)
-
-        text_parts = []
-        total_pages = doc.page_count
-
-        for i in range(min(total_pages, PAGES_FROM_START)):
-            text_parts.append(doc.load_page(i).get_text("text"))
-
-        text_parts.append("\n\n... [DOCUMENT TRUNCATED] ...\n\n")
-
-        if total_pages > PAGES_FROM_START:
-            start_page_for_end = max(PAGES_FROM_START, total_pages - PAGES_FROM_END)
-            for i in range(start_page_for_end, total_pages):
-                text_parts.append(doc.load_page(i).get_text("text"))
-
-        doc.close()
-        full_text = "".join(text_parts)
+        # Without the PRESERVE_LIGATURES/WHITESPACE flags MuPDF skips that extra unicode handling.
+        flags = pymupdf.TEXT_MEDIABOX_CLIP | pymupdf.TEXT_CID_FOR_UNKNOWN_UNICODE
+
+        with pymupdf.open(pdf_path) as doc:
+            total_pages = doc.page_count
+            head = _pages_text(doc.pages(0, min(total_pages, PAGES_FROM_START)), flags)
+            tail = ""
+            if total_pages > PAGES_FROM_START:
+                start_page_for_end = max(PAGES_FROM_START, total_pages - PAGES_FROM_END)
+                tail = _pages_text(doc.pages(start_page_for_end, total_pages), flags)
+
+        full_text = head + "\n\n... [DOCUMENT TRUNCATED] ...\n\n" + tail
         return filename, full_text
 
     except Exception as e:
@@ -99,27 +208,95 @@ def extract_text_from_pdf(pdf_path):
 
 def process_new_paper(arxiv_id: str):
     """
-    The main task function that the RQ worker will execute.
+    The main task function that the background worker will execute.
     Takes an arXiv ID, processes it, and saves it to the databases.
     """
+    return process_new_papers([arxiv_id])[0]
+
+
+def _dumps(value) -> str:
+    return orjson.dumps(value).decode()
+
+
+def _strip_version(arxiv_id: str) -> str:
+    """arXiv returns versioned ids (e.g. 2101.00001v2); match submissions without the version."""
+    return re.sub(r"v\d+$", "", arxiv_id)
+
+
+def process_new_papers(arxiv_ids: list):
+    """
+    Processes several arXiv IDs in one task. Metadata for the whole batch is
+    fetched with a single arXiv API request, PDFs are downloaded and sent to
+    the LLM concurrently, and the successful papers are embedded and saved
+    together. One paper failing does not abort the rest.
+    """
+    print(f"--- [WORKER] Fetching {len(arxiv_ids)} paper(s) from arXiv ---")
+    try:
+        search = arxiv.Search(id_list=arxiv_ids, max_results=len(arxiv_ids))
+        papers = {_strip_version(paper.get_short_id()): paper for paper in arxiv_client.results(search)}
+    except Exception as e:
+        print(f"--- [WORKER] FAILED to fetch arXiv metadata: {e} ---")
+        print(traceback.format_exc())
+        return [f"Failed: {e}" for _ in arxiv_ids]
+
+    outcomes = {}
+    found = []
+    for arxiv_id in arxiv_ids:
+        paper = papers.get(_strip_version(arxiv_id))
+        if paper is None:
+            print(f"--- [WORKER] arXiv ID not found: {arxiv_id} ---")
+            outcomes[arxiv_id] = f"Failed: {arxiv_id} not found on arXiv"
+        else:
+            found.append((arxiv_id, paper))
+
+    # Downloads and LLM calls are network-bound, so run them side by side.
+    extracted = []
+    if found:
+        with ThreadPoolExecutor(max_workers=min(EXTRACTION_WORKERS, len(found))) as executor:
+            futures = [executor.submit(_extract_paper, arxiv_id, paper) for arxiv_id, paper in found]
+            for (arxiv_id, paper), future in zip(found, futures):
+                try:
+                    extracted.append((arxiv_id, paper, future.result()))
+                except Exception as e:
+                    print(f"--- [WORKER] FAILED to process arXiv ID: {arxiv_id} ---")
+                    print(traceback.format_exc())
+                    outcomes[arxiv_id] = f"Failed: {e}"
+
+    if extracted:
+        try:
+            _save_papers(extracted)
+            for arxiv_id, _, _ in extracted:
+                print(f"--- [WORKER] Successfully processed and saved arXiv ID: {arxiv_id} ---")
+                outcomes[arxiv_id] = f"Success: {arxiv_id}"
+        except Exception as e:
+            print(f"--- [WORKER] FAILED to save {len(extracted)} paper(s) ---")
+            print(traceback.format_exc())
+            for arxiv_id, _, _ in extracted:
+                outcomes[arxiv_id] = f"Failed: {e}"
+
+    return [outcomes[arxiv_id] for arxiv_id in arxiv_ids]
+
+
+def _extract_paper(arxiv_id: str, paper):
+    """
+    Downloads a paper whose arXiv metadata has already been fetched and
+    returns the information the LLM extracted from its text.
+    """
     print(f"--- [WORKER] Starting processing for arXiv ID: {arxiv_id} ---")
     pdf_path = None
 
     try:
-        print(f"[WORKER] Fetching data from arXiv...")
-        search = arxiv.Search(id_list=[arxiv_id])
-        paper = next(arxiv_client.results(search))
-
         temp_dir = "./temp_pdfs"
         os.makedirs(temp_dir, exist_ok=True)
-        pdf_path = paper.download_pdf(dirpath=temp_dir, filename=f"{arxiv_id}.pdf")
+        with _download_slots:
+            pdf_path = paper.download_pdf(dirpath=temp_dir, filename=f"{arxiv_id}.pdf")
         print(f"[WORKER] PDF downloaded to: {pdf_path}")
 
         _, full_text = extract_text_from_pdf(pdf_path)
         if not full_text:
             raise ValueError(f"Failed to extract text from PDF for {arxiv_id}")
 
-        print(f"[WORKER] Calling LLM for data extraction...")
+        print(f"[WORKER] Calling LLM for data extraction of {arxiv_id}...")
         prompt = create_extraction_prompt(full_text)
         response = zhipu_client.chat.completions.create(
             model="glm-4-flash",
@@ -128,58 +305,10 @@ def process_new_paper(arxiv_id: str):
         )
 
         content_str = response.choices[0].message.content
-        extracted_info = json.loads(content_str)
-        print(f"[WORKER] LLM extraction successful.")
-
-        print(f"[WORKER] Generating embedding...")
-        text_to_embed = f"{extracted_info.get('title', '')}. {extracted_info.get('abstract', '')}"
-        embedding = embedding_model.encode(text_to_embed)
-
-        print(f"[WORKER] Saving to SQLite...")
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        paper_id_db = arxiv_id
-        cursor.execute(
-            """
-            INSERT INTO papers (
-                id, title, abstract, authors, contribution, tasks, methods, datasets, code_links, results, processed
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE
-            SET title = excluded.title, abstract = excluded.abstract, authors = excluded.authors, contribution = excluded.contribution, tasks = excluded.tasks, methods = excluded.methods, datasets = excluded.datasets, code_links = excluded.code_links, results = excluded.results, processed = excluded.processed
-            """,
-            (
-                paper_id_db,
-                extracted_info.get('title'),
-                extracted_info.get('abstract'),
-                ','.join([str(a) for a in paper.authors]),
-                extracted_info.get('contribution'),
-                json.dumps(extracted_info.get('tasks', [])),
-                json.dumps(extracted_info.get('methods', [])),
-                json.dumps(extracted_info.get('datasets', [])),
-                json.dumps(extracted_info.get('code_links', [])),
-                json.dumps(extracted_info.get('results', [])),
-                2
-            )
-        )
-        conn.commit()
-        conn.close()
-
-        print(f"[WORKER] Saving to ChromaDB...")
-        chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-        paper_collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
-        paper_collection.upsert(
-            ids=[paper_id_db],
-            embeddings=[embedding.tolist()]
-        )
+        extracted_info = orjson.loads(content_str)
+        print(f"[WORKER] LLM extraction successful for {arxiv_id}.")
+        return extracted_info
 
-        print(f"--- [WORKER] Successfully processed and saved arXiv ID: {arxiv_id} ---")
-        return f"Success: {arxiv_id}"
-
-    except Exception as e:
-        print(f"--- [WORKER] FAILED to process arXiv ID: {arxiv_id} ---")
-        print(traceback.format_exc())
-        return f"Failed: {e}"
     finally:
         if pdf_path and os.path.exists(pdf_path):
             try:
@@ -187,3 +316,69 @@ def process_new_paper(arxiv_id: str):
                 print(f"[WORKER] Cleaned up temporary file: {pdf_path}")
             except OSError as e:
                 print(f"[WORKER] Error cleaning up file {pdf_path}: {e}")
+
+
+def _save_papers(extracted: list):
+    """
+    Embeds the extracted papers in a single encode call and writes them to
+    SQLite and ChromaDB, each in one statement.
+    """
+    print(f"[WORKER] Generating {len(extracted)} embedding(s)...")
+    texts_to_embed = [
+        f"{extracted_info.get('title', '')}. {extracted_info.get('abstract', '')}"[:MAX_EMBED_CHARS]
+        for _, _, extracted_info in extracted
+    ]
+    embeddings = get_embedding_model().encode(
+        texts_to_embed, batch_size=64, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+    )
+    # The FP16 model on GPU returns float16, but Chroma's index only stores float32.
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    print(f"[WORKER] Saving to SQLite...")
+    with _sqlite_lock:
+        _save_to_sqlite(extracted)
+
+    print(f"[WORKER] Saving to ChromaDB...")
+    get_paper_collection().upsert(
+        ids=[arxiv_id for arxiv_id, _, _ in extracted],
+        embeddings=embeddings,
+        metadatas=[{"has_code": bool(extracted_info.get('code_links'))} for _, _, extracted_info in extracted],
+    )
+
+
+def _save_to_sqlite(extracted: list):
+    """Upserts the extracted papers in one IMMEDIATE transaction, so the batch costs a single commit."""
+    conn = _get_sqlite_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            """
+            INSERT INTO papers (
+                id, title, abstract, authors, contribution, tasks, methods, datasets, code_links, has_code, results, processed
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE
+            SET title = excluded.title, abstract = excluded.abstract, authors = excluded.authors, contribution = excluded.contribution, tasks = excluded.tasks, methods = excluded.methods, datasets = excluded.datasets, code_links = excluded.code_links, has_code = excluded.has_code, results = excluded.results, processed = excluded.processed
+            """,
+            [
+                (
+                    arxiv_id,
+                    extracted_info.get('title'),
+                    extracted_info.get('abstract'),
+                    _dumps([str(a) for a in paper.authors]),
+                    extracted_info.get('contribution'),
+                    _dumps(extracted_info.get('tasks', [])),
+                    _dumps(extracted_info.get('methods', [])),
+                    _dumps(extracted_info.get('datasets', [])),
+                    _dumps(extracted_info.get('code_links', [])),
+                    bool(extracted_info.get('code_links')),
+                    _dumps(extracted_info.get('results', [])),
+                    2
+                )
+                for arxiv_id, paper, extracted_info in extracted
+            ]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
@@ -1,37 +1,68 @@
-import json
+import ijson
+import orjson
 from tqdm import tqdm
 
 # --- Configuration ---
 INPUT_JSON_FILE = 'meta/arxiv.json'
 OUTPUT_JSONL_FILE = 'meta/arxiv.jsonl'
+READ_CHUNK_SIZE = 1 << 20
+
+
+class ArrayReader:
+    """
+    File-like wrapper that presents the dump's comma-separated objects as a
+    single JSON array, without reading the whole file: it adds the enclosing
+    brackets and drops the trailing comma at the end of the file.
+    """
+
+    def __init__(self, infile):
+        self._chunks = self._iter_chunks(infile)
+        self._buffer = b''
+
+    @staticmethod
+    def _iter_chunks(infile):
+        yield b'['
+        held = b''
+        while chunk := infile.read(READ_CHUNK_SIZE):
+            chunk = held + chunk
+            # Hold back trailing whitespace/comma until we know whether more data follows.
+            body = chunk.rstrip().rstrip(b',')
+            held = chunk[len(body):]
+            yield body
+        yield b']'
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
 
 def convert_json_to_jsonl(input_path, output_path):
     """
-    Reads a file containing a single JSON array and converts it to
+    Streams a file containing a single JSON array and converts it to
     a JSON Lines file where each object is on a new line.
     """
     print(f"Opening '{input_path}'...")
     try:
-        with open(input_path, 'r', encoding='utf-8') as infile:
-            contents = '[' + infile.read().rstrip().rstrip(',') + ']'
-            data = json.loads(contents)
-
-            if not isinstance(data, list):
-                print("Error: The input file is not a JSON array (a list of objects).")
-                return
-
-            print(f"Found {len(data)} objects. Converting to JSONL format...")
-
-            with open(output_path, 'w', encoding='utf-8') as outfile:
-                for entry in tqdm(data, desc="Writing to .jsonl"):
-                    outfile.write(json.dumps(entry) + '\n')
+        with open(input_path, 'rb') as infile, open(output_path, 'wb') as outfile:
+            count = 0
+            for entry in tqdm(ijson.items(ArrayReader(infile), 'item', use_float=True), desc="Writing to .jsonl"):
+                outfile.write(orjson.dumps(entry) + b'\n')
+                count += 1
 
-            print(f"Successfully converted file to '{output_path}'")
+        print(f"Successfully converted {count} objects to '{output_path}'")
 
     except FileNotFoundError:
         print(f"Error: The file '{input_path}' was not found. Please check the path.")
-    except json.JSONDecodeError as e:
+    except ijson.JSONError as e:
         print(f"Error: The file '{input_path}' is not a valid JSON file: {e}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
@@ -1,11 +1,34 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from remotezip import RemoteZip
 
+URL = "https://open-data-set.oss-cn-beijing.aliyuncs.com/dataset/pdf11000.zip"
+# Each extract is a few HTTP range requests, so the download is latency-bound;
+# independent RemoteZip handles let several of them be in flight at once.
+MAX_WORKERS = 16
+OUTPUT_DIR = './pdfs'
+
+
+def extract_files(file_names):
+    with RemoteZip(URL) as z:
+        for file_name in file_names:
+            z.extract(file_name, path=OUTPUT_DIR)
+    return len(file_names)
+
+
 def main():
-    url = "https://open-data-set.oss-cn-beijing.aliyuncs.com/dataset/pdf11000.zip"
-    with RemoteZip(url) as z:
-        all_files = z.namelist()
-        for file_name in all_files[1999:4000]:
-            z.extract(file_name, path='./pdfs')
+    with RemoteZip(URL) as z:
+        all_files = z.namelist()[1999:4000]
+
+    # ZipFile.extract creates missing parents without exist_ok, so threads racing on the
+    # same directory would crash; create them all up front instead.
+    for parent in {os.path.dirname(name) for name in all_files}:
+        os.makedirs(os.path.join(OUTPUT_DIR, parent), exist_ok=True)
+
+    slices = [all_files[i::MAX_WORKERS] for i in range(MAX_WORKERS)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        extracted = sum(executor.map(extract_files, slices))
+    print(f"Extracted {extracted} files to '{OUTPUT_DIR}'.")
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,9 @@
+import argparse
+import os
 import sqlite3
 import chromadb
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
@@ -8,31 +11,125 @@ DB_FILE = "_data/papers.db"
 CHROMA_DB_PATH = "../backend/chroma_db"
 COLLECTION_NAME = "papers"
 MODEL_NAME = 'all-MiniLM-L6-v2'
+# HNSW tuning: M trades memory for recall, construction_ef trades build time for graph
+# quality, and search_ef trades query latency for recall. Only applied on creation.
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+MAX_SEQ_LENGTH = 256
+# Longer text would be cut at MAX_SEQ_LENGTH tokens anyway; trimming first spares the tokenizer.
+MAX_EMBED_CHARS = 1500
+
+BATCH_SIZE = 64
+UPSERT_BATCH_SIZE = 250
+
+
+def get_existing_metadata(collection, page_size=10000):
+    """Returns {id: metadata} for everything already stored, fetched page by page without the embeddings."""
+    existing = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        existing.update(zip(page['ids'], (metadata or {} for metadata in page['metadatas'])))
+        if len(page['ids']) < page_size:
+            return existing
+        offset += page_size
+
+
+def refresh_has_code(collection, papers, existing):
+    """
+    Updates the `has_code` metadata of already embedded papers where it is missing
+    (vectors stored before the field existed) or no longer matches `code_links`.
+    Returns the number of vectors updated.
+    """
+    stale = []
+    for row in papers:
+        paper_id = str(row['id']).strip()
+        has_code = bool(row['has_code'])
+        if paper_id in existing and existing[paper_id].get('has_code') != has_code:
+            stale.append((paper_id, has_code))
+
+    for i in tqdm(range(0, len(stale), UPSERT_BATCH_SIZE), desc="Refreshing has_code metadata"):
+        batch = stale[i:i + UPSERT_BATCH_SIZE]
+        collection.update(
+            ids=[paper_id for paper_id, _ in batch],
+            metadatas=[{"has_code": has_code} for _, has_code in batch],
+        )
+    return len(stale)
+
+
+def verify_stored(collection, test_id):
+    """Reads one upserted embedding back to confirm data is being stored correctly."""
+    try:
+        retrieved = collection.get(ids=[test_id], include=["embeddings"])
+        if not retrieved or not retrieved.get('ids'):
+            print(f"\n--- VERIFICATION FAILED! ---")
+            print(f"ID '{test_id}' could not be found after upsert.")
+            return
+
+        retrieved_embedding = retrieved['embeddings'][0]
+        if retrieved_embedding is None or not isinstance(retrieved_embedding, (list, np.ndarray)):
+            print(f"\n--- VERIFICATION FAILED! ---")
+            print(f"ID '{test_id}' was found, but its embedding is NULL or not a valid array/list.")
+            print(f"Retrieved object: {retrieved}")
+            return
+
+        print(f"\n--- VERIFICATION SUCCEEDED! ---")
+        print(f"Successfully retrieved a valid embedding for ID '{test_id}'.")
+        print("--------------------------------------------\n")
+    except Exception as e:
+        print(f"\nFATAL ERROR during verification get(): {e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Embed papers from SQLite into the ChromaDB collection.")
+    parser.add_argument("--db-file", default=DB_FILE, help="SQLite database to read papers from.")
+    parser.add_argument("--chroma-path", default=CHROMA_DB_PATH, help="ChromaDB persistence directory.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Papers per encode call.")
+    parser.add_argument(
+        "--verify", action=argparse.BooleanOptionalAction, default=True,
+        help="Read one stored embedding back after upserting.",
+    )
+    return parser.parse_args(argv)
 
-BATCH_SIZE = 32
 
-def main():
+def main(argv=None):
     """
     Reads paper data from SQLite, generates embeddings, and upserts them into ChromaDB.
     """
+    args = parse_args(argv)
     print("Initializing model and database connections...")
 
-    model = SentenceTransformer(MODEL_NAME)
-    print(f"SentenceTransformer model '{MODEL_NAME}' loaded.")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer(MODEL_NAME, device=device)
+    if device == "cuda":
+        # Half precision roughly doubles GPU throughput for this small model.
+        model.half()
+    else:
+        torch.set_num_threads(min(8, os.cpu_count() or 1))
+    model.max_seq_length = MAX_SEQ_LENGTH
+    print(f"SentenceTransformer model '{MODEL_NAME}' loaded on {device}.")
 
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    client = chromadb.PersistentClient(path=args.chroma_path)
 
     collection = client.get_or_create_collection(
         name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}
+        metadata=COLLECTION_METADATA
     )
     print(f"ChromaDB collection '{COLLECTION_NAME}' ready.")
 
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(args.db_file)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
-    cursor.execute("SELECT id, title, abstract FROM papers WHERE title IS NOT NULL AND abstract IS NOT NULL")
+    cursor.execute(
+        "SELECT id, title, abstract, (code_links IS NOT NULL AND code_links != '[]') AS has_code "
+        "FROM papers WHERE title IS NOT NULL AND abstract IS NOT NULL"
+    )
     all_papers = cursor.fetchall()
     conn.close()
 
@@ -40,75 +137,81 @@ def main():
         print("No papers found in the SQLite database. Exiting.")
         return
 
-    print(f"Found {len(all_papers)} papers to process.")
+    existing = get_existing_metadata(collection)
+    # Already embedded papers are not re-encoded, but their filter metadata is kept in sync.
+    refreshed = refresh_has_code(collection, all_papers, existing)
+    if refreshed:
+        print(f"Updated the has_code metadata of {refreshed} existing embeddings.")
+
+    all_papers = [row for row in all_papers if str(row['id']).strip() not in existing]
+    if not all_papers:
+        print(f"All papers are already embedded in '{COLLECTION_NAME}'. Nothing to do.")
+        return
+
+    print(f"Found {len(all_papers)} papers to process ({len(existing)} already embedded).")
+
+    # Each batch is padded to its longest text, so batching papers of similar length wastes far less compute.
+    all_papers.sort(key=lambda row: len(row['title']) + len(row['abstract']))
 
     valid_count = 0
     failed_count = 0
-
-    for i in tqdm(range(0, len(all_papers), BATCH_SIZE), desc="Generating and Storing Embeddings"):
-        batch = all_papers[i:i + BATCH_SIZE]
-        paper_ids = [row['id'] for row in batch]
-
-        texts_to_embed = [f"{row['title']}. {row['abstract']}" for row in batch]
-
-        id_to_search = '63bcd73090e50fcafdef9941'
-        if id_to_search in paper_ids:
-            index = paper_ids.index(id_to_search)
-            print(f"Text to embed for ID {id_to_search}: {texts_to_embed[index]}")
-
-        embeddings = model.encode(texts_to_embed, show_progress_bar=False)
-
-        if id_to_search in paper_ids:
-            index = paper_ids.index(id_to_search)
-            print(f"Embedding for ID {id_to_search}: {embeddings[index]}")
-
-        valid_ids = []
-        valid_embeddings = []
-
-        for j, embedding in enumerate(embeddings):
-            if embedding is not None and hasattr(embedding, 'tolist'):
-                valid_ids.append(str(batch[j]['id']).strip())
-                valid_embeddings.append(embedding)
-            else:
-                # Log the problematic paper ID
-                failed_id = str(batch[j]['id']).strip()
-                print(f"Warning: Failed to generate a valid embedding for paper ID: {failed_id}. Skipping.")
-
-        if valid_ids:
-            valid_count += len(valid_ids)
-
-            collection.upsert(
-                ids=valid_ids,
-                embeddings=valid_embeddings
-            )
-
-        test_id = valid_ids[0]
-        try:
-            retrieved = collection.get(ids=[test_id], include=["embeddings"])
-
-            verification_passed = True
-            if not retrieved or not retrieved.get('ids'):
-                verification_passed = False
-                print(f"\n--- VERIFICATION FAILED! ---")
-                print(f"ID '{test_id}' could not be found after upsert.")
-            else:
-                retrieved_embedding = retrieved['embeddings'][0]
-                if retrieved_embedding is None or not isinstance(retrieved_embedding, (list, np.ndarray)):
-                    verification_passed = False
-                    print(f"\n--- VERIFICATION FAILED! ---")
-                    print(f"ID '{test_id}' was found, but its embedding is NULL or not a valid array/list.")
-                    print(f"Retrieved object: {retrieved}")
-
-            if verification_passed:
-                if i == 0:  # Print only for the first batch
-                    print(f"\n--- VERIFICATION SUCCEEDED for batch 1! ---")
-                    print(f"Successfully retrieved a valid embedding for ID '{test_id}'.")
-                    print("This confirms data is being stored and retrieved correctly.")
-                    print("--------------------------------------------\n")
-            else:
-                failed_count += 1
-        except Exception as e:
-            print(f"\nFATAL ERROR during verification get(): {e}")
+    last_id = None
+
+    # Chroma inserts are much faster in batches of a few hundred than in embedding-sized batches.
+    pending_ids = []
+    pending_embeddings = []
+    pending_metadatas = []
+
+    def flush():
+        nonlocal last_id
+        if not pending_ids:
+            return 0
+        collection.upsert(
+            ids=pending_ids, embeddings=np.concatenate(pending_embeddings), metadatas=pending_metadatas
+        )
+        flushed = len(pending_ids)
+        last_id = pending_ids[-1]
+        pending_ids.clear()
+        pending_embeddings.clear()
+        pending_metadatas.clear()
+        return flushed
+
+    for i in tqdm(range(0, len(all_papers), args.batch_size), desc="Generating and Storing Embeddings"):
+        batch = all_papers[i:i + args.batch_size]
+
+        texts_to_embed = [f"{row['title']}. {row['abstract']}"[:MAX_EMBED_CHARS] for row in batch]
+
+        embeddings = model.encode(
+            texts_to_embed,
+            batch_size=args.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        # Chroma stores float32 vectors; a half-precision model on GPU hands back float16.
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        # encode() returns one (N, dim) array; rows with NaN/inf are the ones that failed.
+        valid_mask = np.isfinite(embeddings).all(axis=1)
+        pending_embeddings.append(embeddings[valid_mask])
+        for j in np.flatnonzero(valid_mask):
+            pending_ids.append(str(batch[j]['id']).strip())
+            # Lets the backend push the `has_code` filter down into ChromaDB.
+            pending_metadatas.append({"has_code": bool(batch[j]['has_code'])})
+
+        for j in np.flatnonzero(~valid_mask):
+            # Log the problematic paper ID
+            failed_id = str(batch[j]['id']).strip()
+            print(f"Warning: Failed to generate a valid embedding for paper ID: {failed_id}. Skipping.")
+            failed_count += 1
+
+        if len(pending_ids) >= UPSERT_BATCH_SIZE:
+            valid_count += flush()
+
+    valid_count += flush()
+
+    if args.verify and last_id is not None:
+        verify_stored(collection, last_id)
 
     print("\nEmbedding generation complete!")
     print(f"Total items in collection '{COLLECTION_NAME}': {collection.count()}")
@@ -1,7 +1,9 @@
 import os
-import json
+import orjson
 import sqlite3
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from zhipuai import ZhipuAI
 from tqdm import tqdm
 
@@ -11,8 +13,42 @@ META_JSONL_FILE = "_data/meta/arxiv.jsonl"
 DB_FILE = "_data/papers.db"
 BATCH_INPUT_FILE = "_data/batch_input_final.jsonl"
 BATCH_OUTPUT_FILE = "_data/batch_output_final.jsonl"
+# Batch jobs take hours, so status polls back off from 30 seconds to at most 5 minutes.
+POLL_INITIAL_DELAY = 30
+POLL_MAX_DELAY = 300
+
+# Rows written per executemany/commit when applying batch results.
+WRITE_BATCH_SIZE = 1000
+# Metadata lines handed to each parsing worker at a time.
+META_CHUNK_LINES = 1000
+# Line breaks and tabs inside titles/abstracts become plain spaces.
+_WS_TABLE = str.maketrans({"\n": " ", "\r": " ", "\t": " "})
+
+INSERT_PAPER_SQL = "INSERT OR IGNORE INTO papers (id, title, authors, abstract) VALUES (?, ?, ?, ?)"
+
+UPDATE_RESULTS_SQL = """
+    UPDATE papers 
+    SET contribution = ?, tasks = ?, methods = ?, datasets = ?, 
+        code_links = ?, has_code = ?, results = ?, processed = 1
+    WHERE id = ?
+"""
 
 # --- Database Setup ---
+def connect_db():
+    """Opens the papers database tuned for bulk writes."""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def close_db(conn):
+    """Folds the WAL back into the database file before closing, so the next reader doesn't pay for it."""
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
 def setup_database():
     """Creates the SQLite database with a detailed table schema."""
     print(f"Setting up database at '{DB_FILE}'...")
@@ -29,26 +65,32 @@ def setup_database():
             methods TEXT,
             datasets TEXT,
             code_links TEXT,
+            has_code BOOLEAN DEFAULT 0,
             results TEXT,
             processed INTEGER DEFAULT 0
         )
     ''')
+
+    # Databases created before has_code existed need the column added.
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(papers)")]
+    if 'has_code' not in columns:
+        cursor.execute("ALTER TABLE papers ADD COLUMN has_code BOOLEAN DEFAULT 0")
+        cursor.execute("UPDATE papers SET has_code = (code_links IS NOT NULL AND code_links != '[]')")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_papers_has_code ON papers (has_code)")
     conn.commit()
     conn.close()
     print("Database setup complete.")
 
 
-def create_extraction_prompt(title, abstract):
-    """
-    Creates a highly structured prompt using XML for input clarity
-    and requests a clean JSON object for the output.
-    """
-    return f"""
+# The prompt is fixed apart from the paper fields, so its pieces are built once at import.
+PROMPT_PREFIX = """
 You are an expert research assistant. Your task is to analyze the title and abstract of the academic paper provided below inside the `<paper>` tags and extract key information.
 
 <paper>
-  <title>{title}</title>
-  <abstract>{abstract}</abstract>
+  <title>"""
+PROMPT_MID = """</title>
+  <abstract>"""
+PROMPT_SUFFIX = """</abstract>
 </paper>
 
 Your response MUST be a single, valid JSON object. Do not include any text, explanations, or markdown formatting (like ```json) before or after the JSON object.
@@ -61,77 +103,122 @@ The JSON object must have the following keys: "contribution", "tasks", "methods"
 - If no information is found for a key, return an empty string "" for "contribution" or an empty list [] for the others.
 
 Here is an example of the required output format:
-{{
+{
   "contribution": "This paper introduces a novel attention mechanism that improves performance on translation tasks.",
   "tasks": ["Machine Translation", "GLUE Benchmark"],
   "methods": ["Novel Attention Mechanism", "Transformer"],
   "datasets": ["WMT 2014", "SQuAD"],
   "code_links": ["https://github.com/user/repo"],
   "results": [
-    {{
+    {
       "metric": "BLEU Score",
       "value": "29.3",
       "task": "WMT 2014 En-De"
-    }}
+    }
   ]
-}}
+}
 """
 
 
+def create_extraction_prompt(title, abstract):
+    """
+    Creates a highly structured prompt using XML for input clarity
+    and requests a clean JSON object for the output.
+    """
+    return "".join((PROMPT_PREFIX, title, PROMPT_MID, abstract, PROMPT_SUFFIX))
+
+
 # --- Batch Job Preparation ---
+def build_meta_chunk(first_line_no, lines):
+    """
+    Parses a chunk of metadata lines into database rows and serialized batch requests.
+    Runs in a worker process.
+    """
+    rows = []
+    requests = []
+
+    # Only the id and prompt change between requests, so the request is built once and updated in place.
+    batch_request = {
+        "custom_id": None,
+        "method": "POST",
+        "url": "/v4/chat/completions",
+        "body": {
+            "model": "glm-4-flash",
+            "messages": [{"role": "user", "content": None}],
+            "response_format": {"type": "json_object"},
+            "stream": False,
+            "temperature": 0.0,
+        },
+    }
+    message = batch_request["body"]["messages"][0]
+
+    for i, line in enumerate(lines, first_line_no):
+        try:
+            line = line.rstrip(b',')
+
+            paper_data = orjson.loads(line)
+            paper_id = paper_data.get('_id')
+            title = paper_data.get('title', '').translate(_WS_TABLE).strip()
+            abstract = paper_data.get('abstract', '').translate(_WS_TABLE).strip()
+
+            # The backend expects authors as a JSON array of names.
+            authors = paper_data.get('author') or []
+            if isinstance(authors, str):
+                authors = [a.strip() for a in authors.split(',') if a.strip()]
+
+            if not paper_id or not title or not abstract:
+                continue
+
+            rows.append((paper_id, title, orjson.dumps(authors).decode(), abstract))
+
+            batch_request["custom_id"] = paper_id
+            message["content"] = create_extraction_prompt(title, abstract)
+            requests.append(orjson.dumps(batch_request, option=orjson.OPT_APPEND_NEWLINE))
+
+        except orjson.JSONDecodeError as e:
+            print(f"Warning: Skipping malformed JSON on line {i}: {e}")
+            continue
+
+    return rows, b"".join(requests)
+
+
+def read_meta_chunks(infile, limit):
+    """Yields (first line number, lines) chunks covering the first `limit` lines of the file."""
+    lines = islice(infile, limit)
+    first_line_no = 1
+    while chunk := list(islice(lines, META_CHUNK_LINES)):
+        yield first_line_no, chunk
+        first_line_no += len(chunk)
+
+
 def prepare_batch_file_and_db(limit=10000):
     """
     Parses the meta JSONL, populates the DB, and creates the batch input file.
     """
     print(f"Preparing batch input file '{BATCH_INPUT_FILE}' and populating database...")
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     cursor = conn.cursor()
 
-    with open(META_JSONL_FILE, 'r', encoding='utf-8') as infile, \
-            open(BATCH_INPUT_FILE, 'w', encoding='utf-8') as outfile:
-
-        for i, line in enumerate(tqdm(infile, desc="Processing metadata", total=limit)):
-            if i >= limit:
-                break
-            try:
-                line = line.rstrip(',')
-
-                paper_data = json.loads(line)
-                paper_id = paper_data.get('_id')
-                title = paper_data.get('title', '').strip().replace("\n", " ")
-                abstract = paper_data.get('abstract', '').strip().replace("\n", " ")
+    with open(META_JSONL_FILE, 'rb') as infile, \
+            open(BATCH_INPUT_FILE, 'wb') as outfile, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
 
-                if not paper_id or not title or not abstract:
-                    continue
+        chunks = list(read_meta_chunks(infile, limit))
+        first_line_nos = [first_line_no for first_line_no, _ in chunks]
+        line_chunks = [lines for _, lines in chunks]
 
-                cursor.execute(
-                    "INSERT OR IGNORE INTO papers (id, title, authors, abstract) VALUES (?, ?, ?, ?)",
-                    (paper_id, title, json.dumps(paper_data.get('author')), abstract)
-                )
-
-                prompt_text = create_extraction_prompt(title, abstract)
-
-                batch_request = {
-                    "custom_id": paper_id,
-                    "method": "POST",
-                    "url": "/v4/chat/completions",
-                    "body": {
-                        "model": "glm-4-flash",
-                        "messages": [{"role": "user", "content": prompt_text}],
-                        "response_format": {"type": "json_object"},
-                        "stream": False,
-                        "temperature": 0.0,
-                    },
-                }
-
-                outfile.write(json.dumps(batch_request) + '\n')
-
-            except json.JSONDecodeError as e:
-                print(f"Warning: Skipping malformed JSON on line {i + 1}: {e}")
-                continue
+        progress = tqdm(desc="Processing metadata", total=limit)
+        # map() yields results in submission order, so the batch file keeps the input order.
+        results = executor.map(build_meta_chunk, first_line_nos, line_chunks)
+        for lines, (rows, requests) in zip(line_chunks, results):
+            # All inserts share the one transaction opened by the first executemany.
+            cursor.executemany(INSERT_PAPER_SQL, rows)
+            outfile.write(requests)
+            progress.update(len(lines))
+        progress.close()
 
     conn.commit()
-    conn.close()
+    close_db(conn)
     print(f"Finished preparing. {limit} papers ready for batch processing.")
 
 
@@ -139,50 +226,49 @@ def prepare_batch_file_and_db(limit=10000):
 def process_batch_results():
     """Reads the batch output file, parses the JSON, and updates the database."""
     print(f"Processing results from '{BATCH_OUTPUT_FILE}'...")
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     cursor = conn.cursor()
+    pending_rows = []
 
     try:
         with open(BATCH_OUTPUT_FILE, 'r', encoding='utf-8') as f:
             for line in tqdm(f, desc="Updating database with JSON results"):
+                paper_id = None
                 try:
-                    result_data = json.loads(line)
-                    paper_id = result_data.get('custom_id')
-
-                    print(paper_id)
-
-                    response_body = result_data.get('response', {}).get('body', {})
-                    content_str = response_body.get('choices', [{}])[0].get('message', {}).get('content', '{}')
+                    result_data = orjson.loads(line)
+                    # The envelope shape is fixed, so only the two fields we need are looked up.
+                    paper_id = result_data['custom_id']
+                    content_str = result_data['response']['body']['choices'][0]['message']['content']
 
                     # The LLM output is a JSON string, so we parse it directly.
-                    extracted_info = json.loads(content_str)
+                    extracted_info = orjson.loads(content_str)
 
                     contribution = extracted_info.get('contribution', '')
-                    tasks = json.dumps(extracted_info.get('tasks', []))
-                    methods = json.dumps(extracted_info.get('methods', []))
-                    datasets = json.dumps(extracted_info.get('datasets', []))
-                    code_links = json.dumps(extracted_info.get('code_links', []))
-                    results = json.dumps(extracted_info.get('results', []))
-
-                    cursor.execute(
-                        """
-                        UPDATE papers 
-                        SET contribution = ?, tasks = ?, methods = ?, datasets = ?, 
-                            code_links = ?, results = ?, processed = 1
-                        WHERE id = ?
-                        """,
-                        (contribution, tasks, methods, datasets, code_links, results, paper_id)
+                    tasks = orjson.dumps(extracted_info.get('tasks', [])).decode()
+                    methods = orjson.dumps(extracted_info.get('methods', [])).decode()
+                    datasets = orjson.dumps(extracted_info.get('datasets', [])).decode()
+                    code_links = orjson.dumps(extracted_info.get('code_links', [])).decode()
+                    has_code = bool(extracted_info.get('code_links'))
+                    results = orjson.dumps(extracted_info.get('results', [])).decode()
+
+                    pending_rows.append(
+                        (contribution, tasks, methods, datasets, code_links, has_code, results, paper_id)
                     )
+                    if len(pending_rows) >= WRITE_BATCH_SIZE:
+                        cursor.executemany(UPDATE_RESULTS_SQL, pending_rows)
+                        conn.commit()
+                        pending_rows.clear()
 
-                except (json.JSONDecodeError, IndexError, KeyError) as e:
+                except (orjson.JSONDecodeError, IndexError, KeyError, TypeError) as e:
                     print(f"Warning: Could not process result for paper {paper_id}. Error: {e}")
                     continue
     except FileNotFoundError:
         print(f"Error: Output file '{BATCH_OUTPUT_FILE}' not found.")
         return
 
+    cursor.executemany(UPDATE_RESULTS_SQL, pending_rows)
     conn.commit()
-    conn.close()
+    close_db(conn)
     print("Database has been updated with JSON-extracted information.")
 
 
@@ -219,6 +305,7 @@ def main():
         return
 
     print("Monitoring job status... (This can take a long time)")
+    poll_delay = POLL_INITIAL_DELAY
     while True:
         try:
             job_status = client.batches.retrieve(batch_job.id)
@@ -226,10 +313,10 @@ def main():
                 f"Current job status: {job_status.status} | In-progress: {job_status.in_progress_at} | Completed: {job_status.completed_at}")
             if job_status.status in ['completed', 'failed', 'cancelled']:
                 break
-            time.sleep(60)
         except Exception as e:
             print(f"Error retrieving job status: {e}")
-            time.sleep(60)
+        time.sleep(poll_delay)
+        poll_delay = min(poll_delay * 1.5, POLL_MAX_DELAY)
 
     if job_status.status == 'completed':
         print("Job completed. Retrieving results...")
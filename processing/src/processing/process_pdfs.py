@@ -1,5 +1,7 @@
 import os
-import json
+import mmap
+import hashlib
+import orjson
 import sqlite3
 import time
 import pymupdf
@@ -12,45 +14,101 @@ load_dotenv()
 
 # --- Configuration ---
 ZHIPU_API_KEY = os.getenv("ZHIPU_API_KEY")
+# "pymupdf" (default) or "pdfium"; the latter needs the optional pypdfium2 package.
+PDF_TEXT_BACKEND = os.getenv("PDF_TEXT_BACKEND", "pymupdf")
 PDF_DIRECTORY = "_data/pdfs"
 DB_FILE = "_data/papers.db"
 
 # Base names for batch files; sequence numbers will be appended
 BATCH_INPUT_FILE_PDFS_BASE = "_data/batch_input_pdfs"
 BATCH_OUTPUT_FILE_PDFS_BASE = "_data/batch_output_pdfs"
+# Papers whose extracted text duplicates an already queued paper: {custom_id sent: [duplicate ids]}
+DUPLICATES_FILE_PDFS = "_data/batch_duplicates_pdfs.json"
 
 PDF_PROCESS_LIMIT = 2000
 MAX_BATCH_FILE_SIZE_MB = 45
 MAX_BATCH_FILE_SIZE_BYTES = MAX_BATCH_FILE_SIZE_MB * 1024 * 1024
 
+# Delay between job status checks, growing 1.5x per check up to the cap.
+POLL_INITIAL_DELAY = 30
+POLL_MAX_DELAY = 300
+
+EXTRACT_CHUNKSIZE = 16
+# Pool counts each chunk as one task, so this recycles a worker after roughly 64 PDFs.
+EXTRACT_CHUNKS_PER_CHILD = 64 // EXTRACT_CHUNKSIZE
+STORE_SHRINK_EVERY = 50
+
 PAGES_FROM_START = 15
 PAGES_FROM_END = 10
+TRUNCATION_MARKER = "\n\n... [DOCUMENT TRUNCATED] ...\n\n"
+# The default "text" flags minus ligature and whitespace preservation, which only cost
+# MuPDF time for a prompt that does not need them. Images are never extracted.
+TEXT_FLAGS = pymupdf.TEXTFLAGS_TEXT & ~pymupdf.TEXT_PRESERVE_LIGATURES & ~pymupdf.TEXT_PRESERVE_WHITESPACE
+
+# Rows written per executemany/commit when applying batch results.
+WRITE_BATCH_SIZE = 1000
+
+UPSERT_PAPER_SQL = """
+    INSERT INTO papers (
+        id, title, abstract, contribution, tasks, methods, datasets, code_links, has_code, results, processed
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE
+    SET title = excluded.title, abstract = excluded.abstract, contribution = excluded.contribution, tasks = excluded.tasks, methods = excluded.methods, datasets = excluded.datasets, code_links = excluded.code_links, has_code = excluded.has_code, results = excluded.results, processed = excluded.processed"""
+
+
+def connect_db():
+    """Opens the papers database tuned for bulk writes."""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def close_db(conn):
+    """Checkpoints and truncates the WAL after a bulk write, then closes the connection."""
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+# PDFs handled by this worker process so far.
+_extract_calls = 0
+
 
 def extract_text_from_pdf(pdf_path):
     """
     Worker function that opens a PDF, extracts key text, and returns it.
     Designed to be run in a separate process.
     """
+    global _extract_calls
+    _extract_calls += 1
+    if _extract_calls % STORE_SHRINK_EVERY == 0:
+        # MuPDF keeps fonts and images in a global store across documents; empty it now and then.
+        pymupdf.TOOLS.store_shrink(100)
+
     try:
         filename = os.path.splitext(os.path.basename(pdf_path))[0]
-        doc = pymupdf.open(pdf_path)
+        # One sequential read lets the kernel read ahead, instead of MuPDF's many small seeks and reads.
+        with open(pdf_path, 'rb') as f:
+            data = f.read()
 
         text_parts = []
-        total_pages = doc.page_count
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            total_pages = doc.page_count
 
-        # Extract text from the first few pages
-        for i in range(min(total_pages, PAGES_FROM_START)):
-            text_parts.append(doc.load_page(i).get_text("text"))
+            # Extract text from the first few pages
+            for page in doc.pages(0, min(total_pages, PAGES_FROM_START)):
+                text_parts.append(page.get_text("text", flags=TEXT_FLAGS))
 
-        text_parts.append("\n\n... [DOCUMENT TRUNCATED] ...\n\n")
+            text_parts.append(TRUNCATION_MARKER)
 
-        # Extract text from the last few pages (if the document is long enough)
-        if total_pages > PAGES_FROM_START:
-            start_page_for_end = max(PAGES_FROM_START, total_pages - PAGES_FROM_END)
-            for i in range(start_page_for_end, total_pages):
-                text_parts.append(doc.load_page(i).get_text("text"))
+            # Extract text from the last few pages (if the document is long enough)
+            if total_pages > PAGES_FROM_START:
+                start_page_for_end = max(PAGES_FROM_START, total_pages - PAGES_FROM_END)
+                for page in doc.pages(start_page_for_end, total_pages):
+                    text_parts.append(page.get_text("text", flags=TEXT_FLAGS))
 
-        doc.close()
         full_text = "".join(text_parts)
         return filename, full_text
 
@@ -59,15 +117,12 @@ def extract_text_from_pdf(pdf_path):
         return os.path.splitext(os.path.basename(pdf_path))[0], None
 
 
-def create_extraction_prompt(paper_text):
-    """
-    Creates a highly structured prompt using the extracted PDF text.
-    Requests a clean JSON object for the output.
-    """
-    return f"""You are an expert research assistant. Your task is to read the provided text from an academic paper and extract key information. The text may be truncated.
+# Everything except the document text is constant across papers.
+PROMPT_PREFIX = """You are an expert research assistant. Your task is to read the provided text from an academic paper and extract key information. The text may be truncated.
 
 <document_text>
-{paper_text}
+"""
+PROMPT_SUFFIX = """
 </document_text>
 
 Your response MUST be a single, valid JSON object. Do not include any text, explanations, or markdown formatting (like ```json) before or after the JSON object.
@@ -81,7 +136,7 @@ The JSON object must have the following keys: "title", "abstract", "contribution
 - If no information is found for a key, return an empty string "" or an empty list [].
 
 Example output format:
-{{
+{
   "title": "The Title of the Paper Extracted from the Document",
   "abstract": "The full abstract text extracted directly from the document.",
   "contribution": "This paper introduces a novel attention mechanism that improves performance on translation tasks.",
@@ -90,16 +145,62 @@ Example output format:
   "datasets": ["WMT 2014", "SQuAD"],
   "code_links": ["https://github.com/user/repo"],
   "results": [
-    {{
+    {
       "metric": "BLEU Score",
       "value": "29.3",
       "task": "WMT 2014 En-De"
-    }}
+    }
   ]
-}}
+}
 """
 
 
+def pdfium_page_text(pdf, index):
+    """Returns the text of one page of a pypdfium2 document, releasing the page afterwards."""
+    page = pdf[index]
+    textpage = page.get_textpage()
+    try:
+        # MuPDF ends every page with a newline; pdfium does not, so add one to keep pages apart.
+        return textpage.get_text_range() + "\n"
+    finally:
+        textpage.close()
+        page.close()
+
+
+def extract_text_from_pdf_pdfium(pdf_path):
+    """
+    Same as extract_text_from_pdf, but extracts the text with pdfium through pypdfium2.
+    Used when PDF_TEXT_BACKEND is "pdfium".
+    """
+    import pypdfium2 as pdfium
+
+    filename = os.path.splitext(os.path.basename(pdf_path))[0]
+    try:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            total_pages = len(pdf)
+            text_parts = [pdfium_page_text(pdf, i) for i in range(min(total_pages, PAGES_FROM_START))]
+            text_parts.append(TRUNCATION_MARKER)
+            # Empty unless the document is longer than PAGES_FROM_START.
+            start_page_for_end = max(PAGES_FROM_START, total_pages - PAGES_FROM_END)
+            text_parts.extend(pdfium_page_text(pdf, i) for i in range(start_page_for_end, total_pages))
+        finally:
+            pdf.close()
+        return filename, "".join(text_parts)
+
+    except Exception as e:
+        print(f"Error processing PDF '{pdf_path}': {e}")
+        return filename, None
+
+
+def create_extraction_prompt(paper_text):
+    """
+    Creates a highly structured prompt using the extracted PDF text.
+    Requests a clean JSON object for the output.
+    """
+    return "".join((PROMPT_PREFIX, paper_text, PROMPT_SUFFIX))
+
+
 def prepare_pdf_batch_files():
     """
     Uses a multiprocessing pool to parse PDFs and create batch input files,
@@ -107,7 +208,8 @@ def prepare_pdf_batch_files():
     Returns a list of created batch input file paths.
     """
     print(f"Scanning for PDFs in '{PDF_DIRECTORY}'...")
-    all_pdf_files = [os.path.join(PDF_DIRECTORY, f) for f in os.listdir(PDF_DIRECTORY) if f.endswith(".pdf")]
+    with os.scandir(PDF_DIRECTORY) as it:
+        all_pdf_files = [entry.path for entry in it if entry.is_file() and entry.name.endswith(".pdf")]
 
     if PDF_PROCESS_LIMIT and PDF_PROCESS_LIMIT > 0:
         all_pdf_files = all_pdf_files[:PDF_PROCESS_LIMIT]
@@ -121,56 +223,79 @@ def prepare_pdf_batch_files():
     created_batch_files = []
     current_batch_file_number = 1
     current_batch_file_path = f"{BATCH_INPUT_FILE_PDFS_BASE}_{current_batch_file_number}.jsonl"
-    current_batch_file_size = 0
     outfile = None
 
-    # Use all available CPU cores
-    with multiprocessing.Pool() as pool:
-        results_iterator = pool.imap_unordered(extract_text_from_pdf, all_pdf_files)
+    # Reused for every PDF; only custom_id and the message content are overwritten.
+    batch_request = {
+        "custom_id": None,
+        "method": "POST",
+        "url": "/v4/chat/completions",
+        "body": {
+            "model": "glm-4-flash",
+            "messages": [{"role": "user", "content": None}],
+            "response_format": {"type": "json_object"},
+            "stream": False,
+            "temperature": 0.0,
+        }
+    }
+    message = batch_request["body"]["messages"][0]
+
+    # The same PDF stored under several names yields identical text; only the first copy is sent,
+    # and the others get its extraction when results are applied.
+    text_owners = {}
+    duplicate_ids = {}
+
+    # Use all available CPU cores. Paths are dispatched in chunks to cut per-task IPC, and
+    # workers are recycled periodically so memory held by MuPDF is returned to the OS.
+    with multiprocessing.Pool(maxtasksperchild=EXTRACT_CHUNKS_PER_CHILD) as pool:
+        extract = extract_text_from_pdf_pdfium if PDF_TEXT_BACKEND == "pdfium" else extract_text_from_pdf
+        results_iterator = pool.imap_unordered(extract, all_pdf_files, chunksize=EXTRACT_CHUNKSIZE)
 
         print("Starting parallel PDF text extraction and batch file preparation...")
         for paper_id, text in tqdm(results_iterator, total=len(all_pdf_files), desc="Extracting PDF Text & Building Batches"):
             if text:
-                prompt_text = create_extraction_prompt(text)
-                batch_request = {
-                    "custom_id": paper_id,
-                    "method": "POST",
-                    "url": "/v4/chat/completions",
-                    "body": {
-                        "model": "glm-4-flash",
-                        "messages": [{"role": "user", "content": prompt_text}],
-                        "response_format": {"type": "json_object"},
-                        "stream": False,
-                        "temperature": 0.0,
-                    }
-                }
-                request_line = json.dumps(batch_request) + '\n'
-                request_line_size = len(request_line.encode('utf-8'))
+                # PDFs without a text layer all come out as just the marker, so they are never deduplicated.
+                if text.strip() != TRUNCATION_MARKER.strip():
+                    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+                    owner_id = text_owners.setdefault(digest, paper_id)
+                    if owner_id != paper_id:
+                        duplicate_ids.setdefault(owner_id, []).append(paper_id)
+                        continue
+
+                batch_request["custom_id"] = paper_id
+                message["content"] = create_extraction_prompt(text)
+                request_line = orjson.dumps(batch_request, option=orjson.OPT_APPEND_NEWLINE)
 
                 if outfile is None: # First entry or new batch file
-                    outfile = open(current_batch_file_path, 'w', encoding='utf-8')
+                    outfile = open(current_batch_file_path, 'wb')
                     print(f"Creating batch file: {current_batch_file_path}")
 
-                # Check if adding this request exceeds the max file size
-                if current_batch_file_size > 0 and (current_batch_file_size + request_line_size > MAX_BATCH_FILE_SIZE_BYTES):
+                # Check if adding this request exceeds the max file size.
+                # tell() on the buffered writer counts bytes written so far, flushed or not.
+                current_batch_file_size = outfile.tell()
+                if current_batch_file_size > 0 and (current_batch_file_size + len(request_line) > MAX_BATCH_FILE_SIZE_BYTES):
                     outfile.close()
                     created_batch_files.append(current_batch_file_path)
                     print(f"Completed batch file: {current_batch_file_path} (Size: {current_batch_file_size / (1024*1024):.2f} MB)")
 
                     current_batch_file_number += 1
                     current_batch_file_path = f"{BATCH_INPUT_FILE_PDFS_BASE}_{current_batch_file_number}.jsonl"
-                    outfile = open(current_batch_file_path, 'w', encoding='utf-8')
+                    outfile = open(current_batch_file_path, 'wb')
                     print(f"Creating new batch file: {current_batch_file_path}")
-                    current_batch_file_size = 0
 
                 outfile.write(request_line)
-                current_batch_file_size += request_line_size
 
     if outfile: # Close the last opened file
+        current_batch_file_size = outfile.tell()
         outfile.close()
         created_batch_files.append(current_batch_file_path)
         print(f"Completed batch file: {current_batch_file_path} (Size: {current_batch_file_size / (1024*1024):.2f} MB)")
 
+    with open(DUPLICATES_FILE_PDFS, 'wb') as f:
+        f.write(orjson.dumps(duplicate_ids))
+    duplicate_count = sum(len(ids) for ids in duplicate_ids.values())
+    if duplicate_count:
+        print(f"Skipped {duplicate_count} PDF(s) with the same text as another PDF; recorded in '{DUPLICATES_FILE_PDFS}'.")
 
     if not created_batch_files:
         print("No batch files were created (perhaps no PDFs processed successfully).")
@@ -179,70 +304,109 @@ def prepare_pdf_batch_files():
     return created_batch_files
 
 
-def process_batch_results_pdf(batch_output_file_path):
-    """Reads a specific batch output file, parses the JSON, and UPDATES the ease."""
+def iter_file_lines(f):
+    """
+    Yields the lines of a binary file as bytes, without the trailing newline.
+    Scans a read-only memory map, so no text decoding happens before orjson sees the line.
+    """
+    # mmap refuses zero-length files.
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        end = len(mm)
+        while start < end:
+            newline = mm.find(b'\n', start)
+            if newline == -1:
+                newline = end
+            yield mm[start:newline]
+            start = newline + 1
+
+
+def load_duplicate_ids():
+    """Returns the duplicate paper ids recorded by prepare_pdf_batch_files, keyed by the custom_id that was sent."""
+    try:
+        with open(DUPLICATES_FILE_PDFS, 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def process_batch_results_pdf(batch_output_file_path, conn=None, duplicate_ids=None):
+    """
+    Reads a specific batch output file, parses the JSON, and UPDATES the ease.
+    When `conn` is given the rows are written through it and committing is left to the caller.
+    `duplicate_ids` is the result of load_duplicate_ids(), read from disk when not given.
+    """
     print(f"Processing PDF results from '{batch_output_file_path}'...")
-    conn = sqlite3.connect(DB_FILE)
+    owns_conn = conn is None
+    if owns_conn:
+        conn = connect_db()
     cursor = conn.cursor()
     processed_count = 0
+    pending_rows = []
+    if duplicate_ids is None:
+        duplicate_ids = load_duplicate_ids()
 
     try:
-        with open(batch_output_file_path, 'r', encoding='utf-8') as f:
-            for line in tqdm(f, desc=f"Updating DB from {os.path.basename(batch_output_file_path)}"):
+        with open(batch_output_file_path, 'rb') as f:
+            for line in tqdm(iter_file_lines(f), desc=f"Updating DB from {os.path.basename(batch_output_file_path)}"):
+                paper_id, result_data, content_str = None, None, ''
                 try:
-                    result_data = json.loads(line)
-                    paper_id = result_data.get('custom_id')
+                    result_data = orjson.loads(line)
+                    paper_id = result_data['custom_id']
 
-                    response_body = result_data.get('response', {}).get('body', {})
-                    choices = response_body.get('choices')
-                    if not choices or not isinstance(choices, list) or len(choices) == 0:
+                    choices = result_data['response']['body'].get('choices')
+                    if not choices:
                         print(f"Warning: No 'choices' in response for paper {paper_id}. Skipping.")
                         continue
 
-                    message = choices[0].get('message', {})
-                    content_str = message.get('content', '{}')
+                    content_str = choices[0]['message'].get('content')
 
                     if not content_str or content_str == '{}':
                          print(f"Warning: Empty 'content' in response for paper {paper_id}. Skipping.")
                          continue
 
-                    extracted_info = json.loads(content_str)
+                    extracted_info = orjson.loads(content_str)
 
                     title = extracted_info.get('title', '').strip()
                     abstract = extracted_info.get('abstract', '').strip()
 
                     contribution = extracted_info.get('contribution', '')
-                    tasks = json.dumps(extracted_info.get('tasks', []))
-                    methods = json.dumps(extracted_info.get('methods', []))
-                    datasets = json.dumps(extracted_info.get('datasets', []))
-                    code_links = json.dumps(extracted_info.get('code_links', []))
-                    results = json.dumps(extracted_info.get('results', []))
-
-                    cursor.execute(
-                        """
-                        INSERT INTO papers (
-                            id, title, abstract, contribution, tasks, methods, datasets, code_links, results, processed
+                    tasks = orjson.dumps(extracted_info.get('tasks', [])).decode()
+                    methods = orjson.dumps(extracted_info.get('methods', [])).decode()
+                    datasets = orjson.dumps(extracted_info.get('datasets', [])).decode()
+                    code_links = orjson.dumps(extracted_info.get('code_links', [])).decode()
+                    has_code = bool(extracted_info.get('code_links'))
+                    results = orjson.dumps(extracted_info.get('results', [])).decode()
+
+                    for target_id in (paper_id, *duplicate_ids.get(paper_id, ())):
+                        pending_rows.append(
+                            (target_id, title, abstract, contribution, tasks, methods, datasets, code_links, has_code, results, 2)
                         )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ON CONFLICT(id) DO UPDATE
-                        SET title = excluded.title, abstract = excluded.abstract, contribution = excluded.contribution, tasks = excluded.tasks, methods = excluded.methods, datasets = excluded.datasets, code_links = excluded.code_links, results = excluded.results, processed = excluded.processed""",
-                        (paper_id, title, abstract, contribution, tasks, methods, datasets, code_links, results, 2)
-                    )
+                    if len(pending_rows) >= WRITE_BATCH_SIZE:
+                        cursor.executemany(UPSERT_PAPER_SQL, pending_rows)
+                        if owns_conn:
+                            conn.commit()
+                        pending_rows.clear()
 
                     processed_count +=1
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     print(f"Warning: Could not parse JSON content for paper {paper_id}. Error: {e}. Content: '{content_str[:200]}...'")
                     continue
-                except (IndexError, KeyError, AttributeError) as e: # Added AttributeError
+                except (IndexError, KeyError, AttributeError, TypeError) as e:
                     print(f"Warning: Could not process result structure for paper {paper_id}. Error: {e}. Result data: {result_data}")
                     continue
     except FileNotFoundError:
         print(f"Error: Output file '{batch_output_file_path}' not found.")
-        conn.close()
+        if owns_conn:
+            conn.close()
         return
 
-    conn.commit()
-    conn.close()
+    cursor.executemany(UPSERT_PAPER_SQL, pending_rows)
+    if owns_conn:
+        conn.commit()
+        close_db(conn)
     print(f"Database has been updated with {processed_count} richly extracted PDF information from '{batch_output_file_path}'.")
 
 
@@ -256,9 +420,14 @@ def main():
     # batch_input_files = prepare_pdf_batch_files()
     batch_input_files = []
     batch_output_files = ['_data/batch_output_pdfs_1.jsonl', '_data/batch_output_pdfs_2.jsonl', '_data/batch_output_pdfs_3.jsonl']  # Placeholder for output files
+    duplicate_ids = load_duplicate_ids()
 
+    # One connection and one transaction for all output files.
+    conn = connect_db()
     for file in batch_output_files:
-        process_batch_results_pdf(file)
+        process_batch_results_pdf(file, conn, duplicate_ids)
+    conn.commit()
+    close_db(conn)
 
     return
 
@@ -301,6 +470,7 @@ def main():
 
         print(f"Monitoring job {batch_job.id} status... (This can take a long time)")
         job_status = None
+        poll_delay = POLL_INITIAL_DELAY
         while True:
             try:
                 job_status = client.batches.retrieve(batch_job.id)
@@ -313,10 +483,10 @@ def main():
 
                 if job_status.status in ['completed', 'failed', 'cancelled']:
                     break
-                time.sleep(60) # Check every 60 seconds
             except Exception as e:
-                print(f"Error retrieving job status for {batch_job.id}: {e}. Retrying in 60s.")
-                time.sleep(60)
+                print(f"Error retrieving job status for {batch_job.id}: {e}. Retrying in {poll_delay:.0f}s.")
+            time.sleep(poll_delay)
+            poll_delay = min(poll_delay * 1.5, POLL_MAX_DELAY)
 
         if job_status and job_status.status == 'completed':
             print(f"Job {batch_job.id} completed. Retrieving results...")
@@ -330,7 +500,7 @@ def main():
                 with open(current_batch_output_file, 'wb') as f:
                     f.write(result_content)
                 print(f"Results for job {batch_job.id} saved to '{current_batch_output_file}'.")
-                process_batch_results_pdf(current_batch_output_file)
+                process_batch_results_pdf(current_batch_output_file, duplicate_ids=duplicate_ids)
             except Exception as e:
                 print(f"Error retrieving or saving results for job {batch_job.id}: {e}")
         elif job_status:
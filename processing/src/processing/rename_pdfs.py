@@ -12,25 +12,27 @@ def rename_pdfs_to_uuid(directory):
     renamed_count = 0
     skipped_count = 0
 
-    for filename in os.listdir(directory):
-        original_file_path = os.path.join(directory, filename)
+    # Materialize the listing first so files renamed below are not picked up again mid-scan.
+    with os.scandir(directory) as it:
+        entries = [entry for entry in it if entry.is_file()]
 
-        if os.path.isfile(original_file_path) and filename.lower().endswith(".pdf"):
-            new_filename = f"{uuid.uuid4()}.pdf"
-            new_file_path = os.path.join(directory, new_filename)
+    for entry in entries:
+        filename = entry.name
+        original_file_path = entry.path
 
-            while os.path.exists(new_file_path):
-                new_filename = f"{uuid.uuid4()}.pdf"
-                new_file_path = os.path.join(directory, new_filename)
+        if filename.lower().endswith(".pdf"):
+            # A uuid4 collision is not a realistic concern, so there is no existence check.
+            new_filename = f"{uuid.uuid4().hex}.pdf"
+            new_file_path = os.path.join(directory, new_filename)
 
             try:
-                os.rename(original_file_path, new_file_path)
+                os.replace(original_file_path, new_file_path)
                 print(f"Renamed '{filename}' to '{new_filename}'")
                 renamed_count += 1
             except OSError as e:
                 print(f"Error renaming '{filename}': {e}")
                 skipped_count += 1
-        elif os.path.isfile(original_file_path):
+        else:
             print(f"Skipping '{filename}' as it does not end with .pdf")
             skipped_count += 1
 